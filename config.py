@@ -1,6 +1,7 @@
 import logging
 import requests  # Added import
 from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
 from requests.adapters import HTTPAdapter
 
 # Default configuration
@@ -9,7 +10,10 @@ DEFAULT_CONFIG = {
     'max_depth': 2,
     'max_retries': 5,
     'concurrent_downloads': 5,
+    'rate_limit': 10,  # Maximum requests started per second, shared by all workers
     'timeout': (10, 30),  # (connect timeout, read timeout)
+    'chunk_size': 64 * 1024,  # Bytes read per chunk when streaming assets to disk
+    'cdx_page_size': 10000,  # Snapshot rows requested per CDX API call
 }
 
 # Retry configuration
@@ -30,6 +34,14 @@ ASSET_TAGS = {
     'source': ['src'],
 }
 
+# Tags the Wayback toolbar injects; they are dropped when their URL or inline text points at archive.org
+ARCHIVE_TAGS = frozenset(['script', 'style', 'link', 'iframe'])
+
+# Common menu/navigation containers, matched by tag, id or class (plus role="navigation")
+NAV_TAGS = frozenset(['nav', 'header'])
+NAV_IDS = frozenset(['menu', 'nav', 'primary-menu'])
+NAV_CLASSES = frozenset(['menu', 'navigation', 'navbar', 'main-menu', 'primary-menu', 'top-menu', 'header-menu'])
+
 
 def setup_logging():
     """Configure logging settings."""
@@ -40,15 +52,24 @@ def setup_logging():
     return logging.getLogger('WaybackDownloader')
 
 
-def create_session(retries=None):
-    """Create and configure requests session with retries."""
+def create_session(retries=None, concurrent_downloads=None):
+    """Create and configure requests session with retries and pooled keep-alive connections."""
     if retries is None:
         retries = Retry(**RETRY_CONFIG)
+    if concurrent_downloads is None:
+        concurrent_downloads = DEFAULT_CONFIG['concurrent_downloads']
 
     session = requests.Session()
-    adapter = HTTPAdapter(max_retries=retries)
+    # Size the pool so concurrent workers never evict each other's sockets
+    adapter = HTTPAdapter(
+        pool_connections=max(32, concurrent_downloads),
+        pool_maxsize=max(32, concurrent_downloads * 4),
+        pool_block=False,
+        max_retries=retries
+    )
     session.mount("https://", adapter)
     session.mount("http://", adapter)
-    session.timeout = DEFAULT_CONFIG['timeout']
+    # Advertises br only when a brotli decoder is installed, so responses can always be decoded
+    session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': ACCEPT_ENCODING})
 
     return session
\ No newline at end of file
@@ -1,38 +1,90 @@
 import os
+import re
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse
-import time
-import cssutils
-import logging
+import threading
+from collections import deque
 import utils
-from config import DEFAULT_CONFIG, ASSET_TAGS, setup_logging, create_session
+from urllib3.util.retry import Retry
+from config import (DEFAULT_CONFIG, RETRY_CONFIG, ASSET_TAGS, ARCHIVE_TAGS, NAV_TAGS, NAV_IDS, NAV_CLASSES,
+                    setup_logging, create_session)
+
+# Links and asset references that never point at a downloadable resource
+_SKIP_URL_RE = re.compile(r'(?:data:|javascript:|mailto:|tel:|#)', re.IGNORECASE)
+
+# Statuses that will not change on a retry, so they do not leave a snapshot incomplete
+_PERMANENT_STATUS = frozenset([404, 410])
+
+
+def _is_nav_element(tag):
+    """Match the containers that usually hold a site's menu."""
+    if tag.name in NAV_TAGS or tag.get('id') in NAV_IDS or tag.get('role') == 'navigation':
+        return True
+    classes = tag.get('class')
+    return bool(classes) and not NAV_CLASSES.isdisjoint(classes)
 
 
 class WaybackDownloader:
-    def __init__(self, output_dir=None, max_depth=None, max_retries=None, concurrent_downloads=None):
+    def __init__(self, output_dir=None, max_depth=None, max_retries=None, concurrent_downloads=None,
+                 rate_limit=None):
         # Initialize with defaults or provided values
         self.output_dir = output_dir or DEFAULT_CONFIG['output_dir']
         self.max_depth = max_depth or DEFAULT_CONFIG['max_depth']
         self.max_retries = max_retries or DEFAULT_CONFIG['max_retries']
         self.concurrent_downloads = concurrent_downloads or DEFAULT_CONFIG['concurrent_downloads']
+        self.rate_limit = rate_limit or DEFAULT_CONFIG['rate_limit']
+        self.timeout = DEFAULT_CONFIG['timeout']
+
+        # Per-snapshot tracking shared by the page and asset workers, dropped once a snapshot is done
+        self.visited_pages = {}  # timestamp -> set of page URLs
+        self.asset_paths = {}  # timestamp -> {(url, base_path): Future resolving to the saved asset path}
+        self._pages_lock = threading.Lock()
+        self._assets_lock = threading.Lock()
 
-        # Initialize sets for tracking
-        self.downloaded_urls = set()
-        self.processed_assets = set()
+        # Snapshots where a page or asset hit a transient failure during their last download_page call
+        self.failed_snapshots = set()
+
+        # Archived capture URL -> (saved file, its inode, content type); unchanged assets resolve to the
+        # same capture in every snapshot, so this is kept for the downloader's lifetime
+        self.saved_captures = {}
 
         # Set up logging
         self.logger = setup_logging()
 
-        # Suppress cssutils logging
-        cssutils.log.setLevel(logging.CRITICAL)
-
         # Create output directory
         os.makedirs(self.output_dir, exist_ok=True)
 
-        # Create session
-        self.session = create_session()
+        # Create session and a rate limiter shared by every request
+        retries = Retry(**{**RETRY_CONFIG, 'total': self.max_retries})
+        self.session = create_session(retries, concurrent_downloads=self.concurrent_downloads)
+        self.rate_limiter = utils.TokenBucket(self.rate_limit)
+
+        # Directories this downloader has created, so repeat writes skip the makedirs calls
+        self.created_dirs = set()
+
+        # Assets are written by a background thread while workers keep downloading
+        self.writer = utils.DiskWriter(created_dirs=self.created_dirs)
+
+        # Page and asset pools live as long as the downloader, so snapshots reuse their threads;
+        # they stay separate so pages waiting on their assets can never starve the asset workers
+        self.page_executor = ThreadPoolExecutor(max_workers=self.concurrent_downloads,
+                                                thread_name_prefix='WaybackPage')
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrent_downloads,
+                                           thread_name_prefix='WaybackAsset')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the page and asset workers, finish pending writes and release pooled connections."""
+        self.page_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        self.writer.flush()
+        self.session.close()
 
     def get_wayback_url(self, url, timestamp):
         """Construct proper wayback URL."""
@@ -48,15 +100,18 @@ class WaybackDownloader:
             return None
 
     def get_snapshots(self, url, from_date=None, to_date=None):
-        """Get list of available snapshots for a URL."""
+        """Yield available snapshots for a URL as each CDX API page arrives."""
         try:
             cdx_api_url = "https://web.archive.org/cdx/search/cdx"
             params = {
                 'url': url,
                 'output': 'json',
                 'fl': 'timestamp,original,statuscode,digest',
-                'filter': 'statuscode:200',
-                'collapse': 'digest'
+                # Let the server drop failed and non-HTML captures
+                'filter': ['statuscode:200', 'mimetype:text/html'],
+                'collapse': 'digest',
+                'limit': DEFAULT_CONFIG['cdx_page_size'],
+                'showResumeKey': 'true'
             }
 
             if from_date:
@@ -64,60 +119,119 @@ class WaybackDownloader:
             if to_date:
                 params['to'] = to_date
 
-            self.logger.info(f"Fetching snapshots with params: {params}")
-            response = self.session.get(cdx_api_url, params=params)
-            response.raise_for_status()
+            while True:
+                self.logger.info(f"Fetching snapshots with params: {params}")
+                self.rate_limiter.acquire()
+                response = self.session.get(cdx_api_url, params=params, timeout=self.timeout)
+                response.raise_for_status()
 
-            results = response.json()
-            if not results or len(results) < 2:
-                return []
+                results = response.json()
+                rows = results[1:] if results else []  # Skip header row
 
-            return results[1:]  # Skip header row
+                # A truncated page ends with an empty row followed by [resumeKey]
+                resume_key = None
+                if len(rows) >= 2 and not rows[-2] and len(rows[-1]) == 1:
+                    resume_key = rows[-1][0]
+                    rows = rows[:-2]
+
+                yield from rows
+                if not resume_key:
+                    return
+                params['resumeKey'] = resume_key
 
         except Exception as e:
             self.logger.error(f"Error fetching snapshots: {e}")
-            return []
 
-    def download_with_retry(self, url):
-        """Download URL with retry logic."""
+    def download_with_retry(self, url, stream=False, allow_redirects=True, timestamp=None):
+        """Download URL with retry logic; streamed responses must be closed by the caller.
+
+        A transient failure marks the snapshot at timestamp, if given, as failed.
+        """
         if not url:
             return None
 
+        response = None
         try:
             self.logger.debug(f"Downloading: {url}")
-            response = self.session.get(url)
+            self.rate_limiter.acquire()
+            response = self.session.get(url, timeout=self.timeout, stream=stream,
+                                        allow_redirects=allow_redirects)
             response.raise_for_status()
             return response
         except Exception as e:
+            if response is not None:
+                response.close()
             self.logger.error(f"Error downloading {url}: {e}")
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if timestamp and status not in _PERMANENT_STATUS:
+                self.failed_snapshots.add(timestamp)
             return None
 
     def download_asset(self, url, timestamp, base_path):
-        """Download and save an individual asset."""
-        if not url or url in self.processed_assets:
+        """Download and save an individual asset, once per snapshot directory."""
+        if not url:
             return None
 
-        self.processed_assets.add(url)
+        key = (url, base_path)
+        with self._assets_lock:
+            snapshot_assets = self.asset_paths.setdefault(timestamp, {})
+            future = snapshot_assets.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = snapshot_assets[key] = Future()
+
+        # Another worker already fetched or is fetching this asset; share its result
+        if not is_owner:
+            return future.result()
 
+        asset_path = self._fetch_asset(url, timestamp, base_path)
+        future.set_result(asset_path)
+        return asset_path
+
+    def _fetch_asset(self, url, timestamp, base_path):
+        """Fetch an asset from the archive and save it under base_path."""
         try:
-            wayback_url = self.get_wayback_url(url, timestamp)
-            if not wayback_url:
+            capture_url = self.get_wayback_url(url, timestamp)
+            if not capture_url:
                 return None
 
-            self.logger.debug(f"Downloading asset: {wayback_url}")
-            response = self.download_with_retry(wayback_url)
+            self.logger.debug(f"Downloading asset: {capture_url}")
 
-            if not response:
-                return None
+            # Follow the archive's redirects to the capture it serves, so a capture saved for an
+            # earlier snapshot is linked before its body is ever requested
+            for _ in range(self.session.max_redirects):
+                asset_path = self._link_saved_capture(url, capture_url, base_path)
+                if asset_path:
+                    return asset_path
 
-            content_type = response.headers.get('content-type', '').split(';')[0]
-            asset_path = utils.get_asset_path(url, content_type)
+                response = self.download_with_retry(capture_url, stream=True, allow_redirects=False,
+                                                    timestamp=timestamp)
+                if not response:
+                    return None
+                if not response.is_redirect:
+                    break
 
-            if not asset_path:
+                # Read the short redirect body so the connection goes back to the pool
+                with response:
+                    response.content
+                capture_url = utils.safe_url_join(capture_url, response.headers['location'])
+            else:
+                self.logger.error(f"Too many redirects for asset {url}")
                 return None
 
-            if utils.save_to_file(response.content, base_path, asset_path):
-                return asset_path
+            # Stream the body to the writer so large assets are never held in memory whole
+            with response:
+                content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                asset_path = utils.get_asset_path(url, content_type)
+
+                if not asset_path:
+                    return None
+
+                chunks = response.iter_content(chunk_size=DEFAULT_CONFIG['chunk_size'])
+                if self.writer.write_stream(chunks, base_path, asset_path,
+                                            lambda path: self._remember_capture(capture_url, path, content_type),
+                                            lambda path: self.failed_snapshots.add(timestamp)):
+                    return asset_path
 
             return None
 
@@ -125,150 +239,248 @@ class WaybackDownloader:
             self.logger.error(f"Error processing asset {url}: {e}")
             return None
 
-    def process_html(self, content, timestamp, base_path, original_url):
-        """Process HTML content to download assets and fix links."""
+    def _remember_capture(self, capture_url, path, content_type):
+        """Record a capture whose file is now on disk; runs on the writer thread."""
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return
+        with self._assets_lock:
+            self.saved_captures[capture_url] = (path, inode, content_type)
+
+    def _link_saved_capture(self, url, capture_url, base_path):
+        """Hard-link an already saved copy of a capture under base_path; returns its asset path or None."""
+        with self._assets_lock:
+            saved = self.saved_captures.get(capture_url)
+        if not saved:
+            return None
+
+        saved_path, inode, content_type = saved
+        # A later asset with the same file name replaces the file with a new inode; never link that
+        try:
+            if os.stat(saved_path).st_ino != inode:
+                return None
+        except OSError:
+            return None
+
+        asset_path = utils.get_asset_path(url, content_type)
+        if asset_path and utils.link_file(saved_path, base_path, asset_path, self.created_dirs):
+            self.logger.debug(f"Linked unchanged asset {url} from {saved_path}")
+            return asset_path
+        return None
+
+    def process_html(self, content, timestamp, base_path, original_url, encoding=None):
+        """Process HTML content to download assets and fix links; returns (html bytes, soup, links)."""
         if not content or not timestamp or not base_path or not original_url:
             self.logger.error("Missing required parameters for HTML processing")
-            return None
+            return None, None, []
 
         try:
-            # Convert content to string if needed
+            # Raw bytes go straight to lxml, decoded with the declared charset when there is one
             if isinstance(content, bytes):
-                try:
-                    content = content.decode('utf-8', errors='ignore')
-                except Exception as e:
-                    self.logger.error(f"Error decoding content: {e}")
-                    return None
-
-            soup = BeautifulSoup(content, 'html.parser')
+                soup = BeautifulSoup(content, 'lxml', from_encoding=encoding)
+            else:
+                soup = BeautifulSoup(content, 'lxml')
             base_url = utils.get_base_url(original_url)
 
             if not base_url:
                 self.logger.error("Could not determine base URL")
-                return None
+                return None, None, []
+
+            # Walk the tree once, stripping archive.org elements and collecting assets and anchors.
+            # Toolbar elements hold no child tags, so decomposing them mid-walk is safe.
+            pending = {}  # asset URL -> [(element, attr)], so each asset is fetched once
+            anchors = []
+            for element in soup.find_all(True):
+                name = element.name
+                if name in ARCHIVE_TAGS:
+                    source = element.get('src') or element.get('href')
+                    if source:
+                        is_archive = utils.is_archive_url(source)
+                    else:
+                        is_archive = 'archive.org' in (element.string or '')
+                    if is_archive:
+                        element.decompose()
+                        continue
+
+                if name == 'a':
+                    if element.get('href'):
+                        anchors.append(element)
+                    continue
+
+                for attr in ASSET_TAGS.get(name, ()):
+                    url = element.get(attr)
+                    if url and not _SKIP_URL_RE.match(url):
+                        clean_url = utils.clean_url(url)
+                        if clean_url:
+                            full_url = utils.resolve_url(clean_url, base_url, original_url)
+                            if full_url:
+                                pending.setdefault(full_url, []).append((element, attr))
 
-            # Remove archive.org elements
-            for element in soup.find_all(['script', 'style', 'link', 'iframe']):
-                if element and isinstance(element.string, str) and 'archive.org' in element.string:
-                    element.decompose()
-
-            # Process assets
-            with ThreadPoolExecutor(max_workers=self.concurrent_downloads) as executor:
-                futures = []
-
-                for tag, attrs in ASSET_TAGS.items():
-                    for element in soup.find_all(tag):
-                        for attr in attrs:
-                            if element.get(attr):
-                                url = str(element[attr])
-                                if url and not url.startswith(('data:', 'javascript:', '#', 'mailto:', 'tel:')):
-                                    clean_url = utils.clean_url(url)
-                                    if clean_url:
-                                        full_url = utils.safe_url_join(base_url, clean_url)
-                                        if full_url:
-                                            futures.append((element, attr, executor.submit(
-                                                self.download_asset, full_url, timestamp, base_path)))
-
-                for element, attr, future in futures:
-                    try:
-                        new_path = future.result()
-                        if new_path:
-                            element[attr] = str(new_path)
-                    except Exception as e:
-                        self.logger.error(f"Error processing asset future: {e}")
+            # Start the asset downloads, then rewrite links while they run
+            future_map = {
+                full_url: self.executor.submit(self.download_asset, full_url, timestamp, base_path)
+                for full_url in pending
+            }
 
-            # Fix internal links
-            for a in soup.find_all('a', href=True):
+            # Fix internal links, remembering each target so the crawl needs no second pass
+            links = []
+            for a in anchors:
                 href = a.get('href')
-                if href and not href.startswith(('javascript:', 'mailto:', 'tel:', '#')):
+                if href and not _SKIP_URL_RE.match(href):
                     clean_href = utils.clean_url(href)
                     if clean_href:
-                        joined_url = utils.safe_url_join(base_url, clean_href)
+                        joined_url = utils.resolve_url(clean_href, base_url, original_url)
                         if joined_url:
                             a['href'] = str(joined_url)
+                            links.append(joined_url)
+
+            # Point asset references at the saved copies
+            for full_url, targets in pending.items():
+                try:
+                    new_path = future_map[full_url].result()
+                    if new_path:
+                        for element, attr in targets:
+                            element[attr] = str(new_path)
+                except Exception as e:
+                    self.logger.error(f"Error processing asset future: {e}")
+                    self.failed_snapshots.add(timestamp)
 
+            # Encode straight to UTF-8 bytes rather than building a str and re-encoding it on write
             try:
-                return str(soup)
+                return soup.encode('utf-8'), soup, list(dict.fromkeys(links))
             except Exception as e:
-                self.logger.error(f"Error converting soup to string: {e}")
-                return None
+                self.logger.error(f"Error encoding soup: {e}")
+                return None, None, []
 
         except Exception as e:
             self.logger.error(f"Error processing HTML: {e}")
-            return None
+            return None, None, []
 
     def get_menu_links(self, soup, base_url):
         """Extract menu/navigation links from the page."""
         menu_links = set()
 
-        # Common menu/navigation selectors
-        nav_selectors = [
-            'nav',
-            'header',
-            '.menu',
-            '.navigation',
-            '#menu',
-            '#nav',
-            '.navbar',
-            '[role="navigation"]',
-            '.main-menu',
-            '.primary-menu',
-            '.top-menu',
-            '#primary-menu',
-            '.header-menu'
-        ]
-
-        # Find all navigation elements
-        for selector in nav_selectors:
-            elements = soup.select(selector)
-            for element in elements:
-                # Get all links within this navigation element
-                links = element.find_all('a', href=True)
-                for link in links:
-                    href = link.get('href')
-                    if href and not href.startswith(('javascript:', 'mailto:', 'tel:', '#')):
-                        clean_href = utils.clean_url(href)
-                        if clean_href:
-                            full_url = utils.safe_url_join(base_url, clean_href)
-                            if full_url:
-                                menu_links.add(full_url)
+        # Find all navigation elements in one pass over the tree
+        for element in soup.find_all(_is_nav_element):
+            # Get all links within this navigation element
+            links = element.find_all('a', href=True)
+            for link in links:
+                href = link.get('href')
+                if href and not _SKIP_URL_RE.match(href):
+                    clean_href = utils.clean_url(href)
+                    if clean_href:
+                        full_url = utils.safe_url_join(base_url, clean_href)
+                        if full_url:
+                            menu_links.add(full_url)
 
         return menu_links
 
-    def download_page(self, url, timestamp, depth=0, visited=None):
-        """Download a specific snapshot of a URL and its linked pages."""
-        if visited is None:
-            visited = set()
+    def download_page(self, url, timestamp):
+        """Download a specific snapshot of a URL and crawl its linked pages breadth-first."""
+        if not url:
+            return None
 
-        if not url or url in visited or depth > self.max_depth:
+        if not self._claim_page(url, timestamp):
             return None
 
-        visited.add(url)
+        self.failed_snapshots.discard(timestamp)
+        frontier = deque([(url, 0)])
+        root_filepath = None
+
+        # This thread owns the frontier; workers only fetch pages and report their links
+        in_flight = {}
+
+        while frontier or in_flight:
+            # Keep one page per worker in flight; everything else waits in the frontier
+            while frontier and len(in_flight) < self.concurrent_downloads:
+                page_url, depth = frontier.popleft()
+                in_flight[self.page_executor.submit(self._download_single_page, page_url, timestamp, depth)] = depth
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = in_flight.pop(future)
+                try:
+                    filepath, links = future.result()
+                except Exception as e:
+                    self.logger.error(f"Error processing page future: {e}")
+                    self.failed_snapshots.add(timestamp)
+                    continue
+
+                if depth == 0:
+                    root_filepath = filepath
+
+                for link in links:
+                    if self._claim_page(link, timestamp):
+                        frontier.append((link, depth + 1))
+
+        # Make sure every queued asset is on disk before reporting the page as done
+        self.writer.flush()
+        self._forget_snapshot(timestamp)
+        return root_filepath
+
+    def _claim_page(self, url, timestamp):
+        """Mark a page as visited for a snapshot; returns False if it was already claimed."""
+        with self._pages_lock:
+            snapshot_pages = self.visited_pages.setdefault(timestamp, set())
+            if url in snapshot_pages:
+                return False
+            snapshot_pages.add(url)
+            return True
+
+    def _forget_snapshot(self, timestamp):
+        """Drop the page and asset tracking of a finished snapshot so memory stays flat across snapshots."""
+        with self._pages_lock:
+            self.visited_pages.pop(timestamp, None)
+        with self._assets_lock:
+            self.asset_paths.pop(timestamp, None)
+
+    def _download_single_page(self, url, timestamp, depth):
+        """Download one page snapshot and return its saved path and same-site links to crawl next."""
+        if not url or depth > self.max_depth:
+            return None, []
 
         try:
             wayback_url = self.get_wayback_url(url, timestamp)
             if not wayback_url:
-                return None
+                return None, []
 
             self.logger.info(f"Downloading page: {wayback_url}")
-            response = self.download_with_retry(wayback_url)
+            response = self.download_with_retry(wayback_url, stream=True, timestamp=timestamp)
 
             if not response:
-                return None
+                return None, []
 
             # Create directory for this download
-            parsed_url = urlparse(url)
+            parsed_url = utils.parse_url(url)
             domain = parsed_url.netloc.replace(".", "_")
             page_dir = f"{domain}_{timestamp}"
             full_path = os.path.join(self.output_dir, page_dir)
 
-            os.makedirs(full_path, exist_ok=True)
+            utils.ensure_dir(full_path, self.created_dirs)
+
+            # Linked documents and media are streamed to disk as-is; only HTML is read into memory
+            with response:
+                content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                if content_type and 'html' not in content_type:
+                    asset_path = utils.get_asset_path(url, content_type)
+                    chunks = response.iter_content(chunk_size=DEFAULT_CONFIG['chunk_size'])
+                    filepath = self.writer.write_stream(
+                        chunks, full_path, asset_path,
+                        on_error=lambda path: self.failed_snapshots.add(timestamp)) if asset_path else None
+                    if not filepath:
+                        return None, []
+                    self.logger.info(f"Saved non-HTML page to: {filepath}")
+                    return filepath, []
+
+                content = response.content
+                charset = utils.get_charset(response.headers.get('content-type'))
 
             # Process the HTML content
-            processed_html = self.process_html(response.content, timestamp, full_path, url)
+            processed_html, soup, page_links = self.process_html(content, timestamp, full_path, url, charset)
             if not processed_html:
                 self.logger.error("Failed to process HTML content")
-                return None
+                return None, []
 
             # Generate filename based on URL path
             path = parsed_url.path.strip('/')
@@ -280,36 +492,23 @@ class WaybackDownloader:
 
             # Save the processed HTML
             filepath = os.path.join(full_path, filename)
-            if not utils.save_to_file(processed_html, full_path, filename):
-                return None
+            if not utils.save_to_file(processed_html, full_path, filename, self.created_dirs):
+                self.failed_snapshots.add(timestamp)
+                return None, []
 
             self.logger.info(f"Saved page to: {filepath}")
 
-            # Process menu links first if not at max depth
+            # Collect menu links first, then other internal links, if not at max depth
+            links = []
             if depth < self.max_depth:
-                soup = BeautifulSoup(processed_html, 'html.parser')
-                menu_links = self.get_menu_links(soup, url)
-
-                # Download menu links first
-                for menu_url in menu_links:
-                    if urlparse(menu_url).netloc == parsed_url.netloc:
-                        self.download_page(menu_url, timestamp, depth + 1, visited)
-                        time.sleep(1)  # Rate limiting
-
-                # Then process other internal links if desired
-                for link in soup.find_all('a', href=True):
-                    href = link.get('href')
-                    if href and not href.startswith(('javascript:', 'mailto:', 'tel:', '#')):
-                        clean_href = utils.clean_url(href)
-                        if clean_href:
-                            next_url = utils.safe_url_join(url, clean_href)
-                            if next_url and next_url not in menu_links and urlparse(
-                                    next_url).netloc == parsed_url.netloc:
-                                self.download_page(next_url, timestamp, depth + 1, visited)
-                                time.sleep(1)  # Rate limiting
-
-            return filepath
+                own_netloc = parsed_url.netloc
+                # Menu links lead, and each URL is checked once even when it is also a page link
+                candidates = dict.fromkeys(self.get_menu_links(soup, url))
+                candidates.update(dict.fromkeys(page_links))
+                links = [link for link in candidates if utils.parse_url(link).netloc == own_netloc]
+
+            return filepath, links
 
         except Exception as e:
             self.logger.error(f"Error downloading page {url}: {e}")
-            return None
\ No newline at end of file
+            return None, []
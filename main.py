@@ -1,10 +1,110 @@
-from datetime import datetime
-import time
 from downloader import WaybackDownloader
+from config import DEFAULT_CONFIG
+import argparse
+import json
 import os
+import sys
+
+# Digests of snapshots downloaded without errors, keyed by URL and crawl depth, kept in the download directory
+SEEN_DIGESTS_FILE = '.seen_digests.json'
+
+
+def load_seen_digests(path):
+    """Load the snapshot digests downloaded by earlier runs."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            seen_digests = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # A cache of any other shape is ignored rather than trusted
+    return seen_digests if isinstance(seen_digests, dict) else {}
+
+
+def digests_for_depth(seen_digests, url, max_depth):
+    """Collect the digests downloaded for a URL by runs that crawled at least max_depth deep."""
+    by_depth = seen_digests.get(url)
+    # Caches from before depths were recorded hold a plain list; those snapshots are fetched again
+    if not isinstance(by_depth, dict):
+        return set()
+    found = set()
+    for depth, digests in by_depth.items():
+        try:
+            depth = int(depth)
+        except ValueError:
+            continue
+        if depth >= max_depth and isinstance(digests, list):
+            found.update(digest for digest in digests if isinstance(digest, str))
+    return found
+
+
+def record_digest(seen_digests, url, max_depth, digest):
+    """Remember a snapshot digest as fully downloaded at the given crawl depth."""
+    by_depth = seen_digests.get(url)
+    if not isinstance(by_depth, dict):
+        by_depth = seen_digests[url] = {}
+    digests = by_depth.get(str(max_depth))
+    digests = {d for d in digests if isinstance(d, str)} if isinstance(digests, list) else set()
+    digests.add(digest)
+    by_depth[str(max_depth)] = sorted(digests)
+
+
+def save_seen_digests(path, seen_digests):
+    """Persist downloaded snapshot digests so later runs can skip them."""
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(seen_digests, f)
+    except OSError as e:
+        print(f"Warning: Could not save digest cache to {path}: {e}")
+
+
+def format_timestamp(timestamp):
+    """Format a 14-digit Wayback timestamp (YYYYMMDDhhmmss) as 'YYYY-MM-DD hh:mm:ss'."""
+    return (f"{timestamp[0:4]}-{timestamp[4:6]}-{timestamp[6:8]} "
+            f"{timestamp[8:10]}:{timestamp[10:12]}:{timestamp[12:14]}")
+
+
+def positive(convert):
+    """Build an argparse type that only accepts values greater than zero."""
+    def parse(value):
+        try:
+            number = convert(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid number: {value!r}")
+        if not number > 0:
+            raise argparse.ArgumentTypeError(f"must be greater than zero: {value!r}")
+        return number
+    return parse
+
+
+def parse_args():
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Download websites from the Wayback Machine.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="list every downloaded file when the download completes")
+    parser.add_argument('-c', '--concurrency', type=positive(int), default=DEFAULT_CONFIG['concurrent_downloads'],
+                        help="number of pages and assets downloaded in parallel")
+    parser.add_argument('-r', '--rate-limit', type=positive(float), default=DEFAULT_CONFIG['rate_limit'],
+                        help="maximum requests per second across all downloads")
+    return parser.parse_args()
+
+
+def iter_tree_lines(path, level=0):
+    """Yield an indented listing of a directory tree, files before subdirectories."""
+    yield f"{' ' * 4 * level}{os.path.basename(path)}/"
+
+    with os.scandir(path) as it:
+        entries = list(it)
+
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            yield f"{' ' * 4 * (level + 1)}{entry.name}"
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_tree_lines(entry.path, level + 1)
 
 
 def main():
+    args = parse_args()
     try:
         # Get the current script's directory
         current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -13,62 +113,72 @@ def main():
 
         print(f"Files will be saved to: {download_dir}")
 
-        downloader = WaybackDownloader(
-            output_dir=download_dir,
-            max_depth=int(input("Enter maximum crawl depth (0-5): ")),
-            max_retries=5,
-            concurrent_downloads=5
-        )
-
-        url = input("Enter the URL to download (e.g., example.com): ")
-        if not url.startswith(('http://', 'https://')):
-            url = 'http://' + url
-
-        from_date = input("Enter start date (YYYYMMDD) or press Enter to skip: ")
-        to_date = input("Enter end date (YYYYMMDD) or press Enter to skip: ")
-
-        print(f"Fetching snapshots for {url}...")
-        snapshots = downloader.get_snapshots(url, from_date, to_date)
-
-        if not snapshots:
-            print("No snapshots found for the given URL and date range.")
-            return
-
-        print(f"Found {len(snapshots)} snapshots.")
-
-        for snapshot in snapshots:
-            timestamp = snapshot[0]
-            formatted_date = datetime.strptime(timestamp, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
-            print(f"\nDownloading snapshot from {formatted_date}...")
-
-            try:
-                filepath = downloader.download_page(url, timestamp)
-                if filepath:
-                    print(f"Saved to: {filepath}")
-                    # Verify that the file exists
-                    if os.path.exists(filepath):
-                        print(f"Successfully verified file at: {filepath}")
-                    else:
-                        print(f"Warning: File was not found at: {filepath}")
-                time.sleep(2)  # Rate limiting
-            except Exception as e:
-                print(f"Error downloading snapshot: {e}")
-                continue
+        # Closing the downloader stops its worker threads and waits for pending writes
+        with WaybackDownloader(
+                output_dir=download_dir,
+                max_depth=int(input("Enter maximum crawl depth (0-5): ")),
+                max_retries=5,
+                concurrent_downloads=args.concurrency,
+                rate_limit=args.rate_limit
+        ) as downloader:
+            url = input("Enter the URL to download (e.g., example.com): ")
+            if not url.startswith(('http://', 'https://')):
+                url = 'http://' + url
+
+            from_date = input("Enter start date (YYYYMMDD) or press Enter to skip: ")
+            to_date = input("Enter end date (YYYYMMDD) or press Enter to skip: ")
+
+            seen_path = os.path.join(download_dir, SEEN_DIGESTS_FILE)
+            seen_digests = load_seen_digests(seen_path)
+            seen = digests_for_depth(seen_digests, url, downloader.max_depth)
+
+            # Snapshots arrive page by page from the CDX API, so downloading starts with the first one
+            print(f"Fetching snapshots for {url}...")
+            found = 0
+            for found, snapshot in enumerate(downloader.get_snapshots(url, from_date, to_date), 1):
+                timestamp, digest = snapshot[0], snapshot[3]
+                # Identical content was already downloaded from another snapshot or an earlier run
+                if digest in seen:
+                    print(f"\nSkipping snapshot {timestamp}: content already downloaded")
+                    continue
+
+                formatted_date = format_timestamp(timestamp)
+                print(f"\nDownloading snapshot from {formatted_date}...")
+
+                try:
+                    filepath = downloader.download_page(url, timestamp)
+                    if filepath:
+                        print(f"Saved to: {filepath}")
+                        seen.add(digest)
+                        # Only complete snapshots are remembered, so a later run can fill in what failed
+                        if timestamp in downloader.failed_snapshots:
+                            print("Some pages or assets failed; the next run will retry this snapshot")
+                        else:
+                            record_digest(seen_digests, url, downloader.max_depth, digest)
+                            save_seen_digests(seen_path, seen_digests)
+                        # Verify that the file exists
+                        if os.path.exists(filepath):
+                            print(f"Successfully verified file at: {filepath}")
+                        else:
+                            print(f"Warning: File was not found at: {filepath}")
+                except Exception as e:
+                    print(f"Error downloading snapshot: {e}")
+                    continue
+
+            if not found:
+                print("No snapshots found for the given URL and date range.")
+                return
+
+            print(f"\nProcessed {found} snapshots.")
 
         print("\nDownload complete!")
 
         # List the contents of the download directory
-        if os.path.exists(download_dir):
-            print("\nContents of download directory:")
-            for root, dirs, files in os.walk(download_dir):
-                level = root.replace(download_dir, '').count(os.sep)
-                indent = ' ' * 4 * level
-                print(f"{indent}{os.path.basename(root)}/")
-                subindent = ' ' * 4 * (level + 1)
-                for f in files:
-                    print(f"{subindent}{f}")
-        else:
+        if not os.path.exists(download_dir):
             print(f"\nWarning: Download directory not found at {download_dir}")
+        elif args.verbose:
+            print("\nContents of download directory:")
+            sys.stdout.write('\n'.join(iter_tree_lines(download_dir)) + '\n')
 
     except Exception as e:
         print(f"An error occurred in main: {e}")
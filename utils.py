@@ -2,11 +2,41 @@ import os
 import re
 import logging
 import mimetypes
+import queue
+import itertools
+import threading
+import time
+from functools import lru_cache
 from urllib.parse import urlparse, urljoin
 
 logger = logging.getLogger('WaybackDownloader')
 
+# Menus, footers and asset references repeat across pages, so URL helpers are memoized
+URL_CACHE_SIZE = 8192
 
+# Wayback URL wrapper: [[[https:]//]web.archive.org]/web/<timestamp>[<modifier>_]/<original url>
+ARCHIVE_URL_RE = re.compile(r'^(?:(?:(?:https?:)?//)?web\.archive\.org)?/web/\d+(?:[a-z]{2}_)?/(?:(https?:)//)?',
+                            re.IGNORECASE)
+
+# Upper bound on buffers per os.writev call (POSIX guarantees IOV_MAX >= 16; Linux allows 1024)
+WRITEV_MAX_BUFFERS = 1024
+
+CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def parse_url(url):
+    """Parse a URL, memoized since the same links and assets recur across pages."""
+    return urlparse(url)
+
+
+@lru_cache(maxsize=256)
+def guess_extension(content_type):
+    """Guess a file extension for a MIME type; only a handful of types ever occur."""
+    return mimetypes.guess_extension(content_type)
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def safe_url_join(base, url):
     """Safely join base URL with another URL."""
     if not base or not url:
@@ -18,18 +48,35 @@ def safe_url_join(base, url):
         return None
 
 
+def resolve_url(url, base_url, page_url):
+    """Resolve a link found on page_url; base_url is its scheme://host, computed once per page."""
+    # Links with dot segments (/./, /../) are left to urljoin, which normalizes them
+    if '/.' in url:
+        return safe_url_join(page_url, url)
+    # Absolute, protocol-relative and root-relative links need no urljoin call
+    if url.startswith(('http://', 'https://')):
+        return url
+    if url.startswith('//'):
+        return base_url[:base_url.index(':') + 1] + url
+    if url.startswith('/'):
+        return base_url + url
+    return safe_url_join(page_url, url)
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def get_base_url(url):
     """Safely extract base URL."""
     if not url:
         return None
     try:
-        parsed = urlparse(str(url))
+        parsed = parse_url(str(url))
         return f"{parsed.scheme}://{parsed.netloc}" if parsed.scheme and parsed.netloc else None
     except Exception as e:
         logger.error(f"Error getting base URL from {url}: {e}")
         return None
 
 
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def clean_url(url):
     """Remove archive.org components from URL."""
     if not url:
@@ -43,33 +90,50 @@ def clean_url(url):
         if url.startswith('data:'):
             return url
 
-        # Remove archive.org components
-        if 'web.archive.org/web/' in url:
-            match = re.search(r'/web/\d+/(https?://)?(.+)', url)
-            if match:
-                cleaned = match.group(2)
-                if not cleaned.startswith(('http://', 'https://')):
-                    cleaned = 'http://' + cleaned
-                return cleaned
-
-        # Ensure URL has protocol
-        if not url.startswith(('http://', 'https://')):
-            url = 'http://' + url
-
-        return url
+        # Unwrap Wayback URLs, keeping the original scheme; everything else passes through as-is
+        return ARCHIVE_URL_RE.sub(_unwrap_archive_url, url, count=1)
 
     except Exception as e:
         logger.error(f"Error cleaning URL {url}: {e}")
         return None
 
 
+def _unwrap_archive_url(match):
+    """Replace a matched Wayback prefix with the original URL's scheme, defaulting to http."""
+    return f"{(match.group(1) or 'http:').lower()}//"
+
+
+def get_charset(content_type):
+    """Extract the charset parameter from a Content-Type header value."""
+    if not content_type:
+        return None
+    match = CHARSET_RE.search(str(content_type))
+    return match.group(1).lower() if match else None
+
+
+def is_archive_url(url):
+    """Check whether a URL points at archive.org's own assets rather than an archived resource."""
+    if not url:
+        return False
+
+    url = str(url)
+    # Wayback serves its toolbar assets from a root-relative /_static/ path
+    if url.startswith('/_static/'):
+        return True
+    # Wrapped URLs are archived resources of the page, whatever host they were captured from
+    if ARCHIVE_URL_RE.match(url):
+        return False
+    host = parse_url(url).hostname or ''
+    return host == 'archive.org' or host.endswith('.archive.org')
+
+
 def get_asset_path(url, content_type=None):
     """Generate appropriate asset path."""
     if not url:
         return None
 
     try:
-        parsed = urlparse(url)
+        parsed = parse_url(url)
         path = parsed.path.lstrip('/')
 
         if not path:
@@ -77,7 +141,7 @@ def get_asset_path(url, content_type=None):
         elif not os.path.splitext(path)[1]:
             # No extension, try to determine from content type
             if content_type:
-                ext = mimetypes.guess_extension(content_type)
+                ext = guess_extension(content_type)
                 if ext:
                     path += ext
             else:
@@ -90,22 +154,218 @@ def get_asset_path(url, content_type=None):
         return None
 
 
-def save_to_file(content, base_path, relative_path):
+def ensure_dir(path, created_dirs=None):
+    """Create a directory tree; paths recorded in created_dirs skip the syscalls on later calls."""
+    if created_dirs is not None and path in created_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    if created_dirs is not None:
+        created_dirs.add(path)
+
+
+def with_parent_dir(path, action, created_dirs=None):
+    """Run action() once path's directory exists, recreating it once if it was removed after being cached."""
+    directory = os.path.dirname(path)
+    ensure_dir(directory, created_dirs)
+    try:
+        return action()
+    except FileNotFoundError:
+        if created_dirs is not None:
+            created_dirs.discard(directory)
+        ensure_dir(directory, created_dirs)
+        return action()
+
+
+def save_to_file(content, base_path, relative_path, created_dirs=None):
     """Save content to file system."""
     if not content or not base_path or not relative_path:
         return False
 
     try:
         full_path = os.path.join(base_path, relative_path)
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        mode, encoding = ('w', 'utf-8') if isinstance(content, str) else ('wb', None)
 
-        if isinstance(content, str):
-            with open(full_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-        else:
-            with open(full_path, 'wb') as f:
+        def write():
+            with open(full_path, mode, encoding=encoding) as f:
                 f.write(content)
+
+        with_parent_dir(full_path, write, created_dirs)
         return True
     except Exception as e:
         logger.error(f"Error saving to {full_path}: {e}")
-        return False
\ No newline at end of file
+        return False
+
+
+def link_file(source, base_path, relative_path, created_dirs=None):
+    """Hard-link an already saved file under base_path; returns False if it could not be linked."""
+    full_path = os.path.join(base_path, relative_path)
+    if full_path == source:
+        return os.path.exists(source)
+
+    try:
+        # Link under a temporary name first so an existing file is replaced atomically
+        temp_path = f"{full_path}.link{threading.get_ident()}"
+        with_parent_dir(full_path, lambda: os.link(source, temp_path), created_dirs)
+        os.replace(temp_path, full_path)
+        return True
+    except OSError as e:
+        logger.debug(f"Could not link {source} to {full_path}: {e}")
+        return False
+
+
+class DiskWriter:
+    """Save files from a single background thread so download workers never block on disk I/O.
+
+    Content is queued chunk by chunk through a bounded queue, so memory held for pending
+    writes stays near chunk size x max_pending however large the files are. The writer drains
+    up to max_batch queued chunks per wake-up and writes each file's share with one writev
+    call. Each stream is written to a temporary file and moved into place once complete.
+    """
+
+    _EOF = object()
+    _ABORT = object()
+
+    def __init__(self, max_pending=256, max_batch=64, created_dirs=None):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.max_batch = max_batch
+        self.created_dirs = set() if created_dirs is None else created_dirs
+        self._stream_ids = itertools.count()
+        self._thread = threading.Thread(target=self._writer_loop, name='WaybackDiskWriter', daemon=True)
+        self._thread.start()
+
+    def write_stream(self, chunks, base_path, relative_path, on_complete=None, on_error=None):
+        """Queue an iterable of byte chunks as one file; returns its full path, or None on failure.
+
+        on_complete, if given, is called with the full path from the writer thread once the file is in place;
+        on_error is called with it if reading the chunks or writing the file fails.
+        """
+        if not base_path or not relative_path:
+            return None
+
+        # Paths are built once here; the writer thread only ever reads them back
+        full_path = os.path.join(base_path, relative_path)
+        stream = (full_path, f"{full_path}.part{next(self._stream_ids)}", on_complete, on_error)
+        written = 0
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self._queue.put((stream, chunk))
+                    written += len(chunk)
+        except Exception as e:
+            logger.error(f"Error streaming content for {full_path}: {e}")
+            written = 0
+            if on_error:
+                on_error(full_path)
+
+        self._queue.put((stream, self._EOF if written else self._ABORT))
+        return full_path if written else None
+
+    def flush(self):
+        """Block until every queued write has reached the file system."""
+        self._queue.join()
+
+    def _writer_loop(self):
+        # Open part files and failed streams are only ever touched by this thread
+        open_files = {}
+        failed = set()
+        while True:
+            batch = [self._queue.get()]
+            # Drain whatever is already queued so each file's chunks go out in one vectored write
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending = {}
+            for stream, chunk in batch:
+                if chunk is self._EOF or chunk is self._ABORT:
+                    self._write_chunks(stream, pending.pop(stream, None), open_files, failed)
+                    self._finish_stream(stream, chunk is self._EOF, open_files, failed)
+                else:
+                    pending.setdefault(stream, []).append(chunk)
+
+            for stream, chunks in pending.items():
+                self._write_chunks(stream, chunks, open_files, failed)
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_chunks(self, stream, chunks, open_files, failed):
+        if not chunks or stream in failed:
+            return
+
+        full_path, part_path = stream[:2]
+        try:
+            handle = open_files.get(stream)
+            if handle is None:
+                handle = open_files[stream] = with_parent_dir(
+                    part_path, lambda: open(part_path, 'wb', buffering=0), self.created_dirs)
+            write_all(handle.fileno(), chunks)
+        except Exception as e:
+            logger.error(f"Error saving to {full_path}: {e}")
+            failed.add(stream)
+
+    def _finish_stream(self, stream, complete, open_files, failed):
+        full_path, part_path, on_complete, on_error = stream
+        try:
+            handle = open_files.pop(stream, None)
+            if handle:
+                handle.close()
+                if complete and stream not in failed:
+                    os.replace(part_path, full_path)
+                    if on_complete:
+                        on_complete(full_path)
+                    return
+                os.remove(part_path)
+            # Complete streams only end up here when writing them failed; aborts were reported by write_stream
+            if complete and on_error:
+                on_error(full_path)
+        except Exception as e:
+            logger.error(f"Error saving to {full_path}: {e}")
+            if on_error:
+                on_error(full_path)
+        finally:
+            failed.discard(stream)
+
+
+def write_all(fd, chunks):
+    """Write byte chunks to a file descriptor, batching them into writev calls where available."""
+    views = [memoryview(chunk) for chunk in chunks]
+    while views:
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, views[:WRITEV_MAX_BUFFERS])
+        else:
+            written = os.write(fd, views[0])
+
+        # Drop fully written buffers and resume a partially written one where it stopped
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+
+class TokenBucket:
+    """Thread-safe token bucket that caps how many requests start per second across all workers."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # At least one whole token must fit, or rates below 1/s could never be served
+        self.capacity = max(1, capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
\ No newline at end of file